@@ -17,23 +17,21 @@ def masked_log_softmax(
     do it yourself before passing the mask into this function.
     In the case that the input vector is completely masked, the return value of this function is
     arbitrary, but not ``nan``.  You should be masking the result of whatever computation comes out
-    of this in that case, anyway, so the specific values returned shouldn't matter.  Also, the way
-    that we deal with this case relies on having single-precision floats; mixing half-precision
-    floats with fully-masked vectors will likely give you ``nans``.
-    If your logits are all extremely negative (i.e., the max value in your logit vector is -50 or
-    lower), the way we handle masking here could mess you up.  But if you've got logit values that
-    extreme, you've got bigger problems than this.
+    of this in that case, anyway, so the specific values returned shouldn't matter.
     """
     if mask is not None:
-        mask = mask.float()
+        if mask.dtype != torch.bool:
+            mask = mask.to(torch.bool)
         while mask.dim() < vector.dim():
             mask = mask.unsqueeze(1)
-        # vector + mask.log() is an easy way to zero out masked elements in logspace, but it
-        # results in nans when the whole vector is masked.  We need a very small value instead of a
-        # zero in the mask for these cases.  log(1 + 1e-45) is still basically 0, so we can safely
-        # just add 1e-45 before calling mask.log().  We use 1e-45 because 1e-46 is so small it
-        # becomes 0 - this is just the smallest value we can actually use.
-        vector = vector + (mask + 1e-45).log()
+        # Filling masked elements with -inf would give nans when the whole vector is masked, so we
+        # use the most negative finite value of the dtype instead.  log_softmax subtracts the max
+        # first, so a fully masked vector just becomes uniform and a partially masked one gets
+        # exactly zero probability at the masked positions.
+        vector = vector.masked_fill(~mask, torch.finfo(vector.dtype).min)
+    # Reduce at least in single precision, e.g., under autocast with half-precision logits
+    if vector.dtype in (torch.float16, torch.bfloat16):
+        vector = vector.float()
     return torch.nn.functional.log_softmax(vector, dim=dim)
 
 
@@ -63,12 +61,26 @@ def masked_max(
     -------
     A ``torch.Tensor`` of including the maximum values.
     """
-    one_minus_mask = (1.0 - mask).byte()
-    replaced_vector = vector.masked_fill(one_minus_mask, min_val)
+    bool_mask = mask.to(torch.bool)
+    replaced_vector = vector.masked_fill(~bool_mask, min_val)
     max_value, max_index = replaced_vector.max(dim=dim, keepdim=keepdim)
     return max_value, max_index
 
 
+def masked_log_softmax_argmax(
+    vector: torch.Tensor, mask: torch.Tensor, dim: int = -1
+) -> Tuple[torch.Tensor, torch.Tensor]:
+    """
+    ``masked_log_softmax`` followed by an argmax over the same ``dim``, for use at every decoding
+    step. The masking is left to ``masked_log_softmax``; fusing the ops is left to ``torch.compile``.
+    Returns
+    -------
+    A tuple of the masked log-softmax and the indices of its maximum values along ``dim``.
+    """
+    log_score = masked_log_softmax(vector, mask, dim=dim)
+    return log_score, log_score.argmax(dim=dim)
+
+
 class Encoder(nn.Module):
     def __init__(
         self,
@@ -89,16 +101,23 @@ class Encoder(nn.Module):
             bidirectional=bidirectional,
         )
 
-    def forward(self, embedded_inputs, input_lengths):
+    def forward(self, inputs, input_lengths, embedding=None):
         # Pack padded batch of sequences for RNN module
+        # input_lengths is expected on CPU, as pack_padded_sequence needs it there
         packed = nn.utils.rnn.pack_padded_sequence(
-            embedded_inputs, input_lengths.to("cpu"), batch_first=self.batch_first
+            inputs, input_lengths, batch_first=self.batch_first
         )
+        if embedding is not None:
+            # Embed only the packed (non-padded) inputs
+            packed = packed._replace(data=embedding(packed.data))
         # Forward pass through RNN
         outputs, hidden = self.rnn(packed)
         # Unpack padding
+        # Keep the padded length of the input, which may be longer than the longest sequence
         outputs, _ = nn.utils.rnn.pad_packed_sequence(
-            outputs, batch_first=self.batch_first
+            outputs,
+            batch_first=self.batch_first,
+            total_length=inputs.size(1 if self.batch_first else 0),
         )
         # Return output and final hidden state
         return outputs, hidden
@@ -112,16 +131,31 @@ class Attention(nn.Module):
         self.W2 = nn.Linear(hidden_size, hidden_size, bias=False)
         self.vt = nn.Linear(hidden_size, 1, bias=False)
 
-    def forward(self, decoder_state, encoder_outputs, mask):
+    def precompute(self, encoder_outputs):
+        # W1 * e_j does not depend on the decoder state, so it is computed once per sequence
         # (batch_size, max_seq_len, hidden_size)
-        encoder_transform = self.W1(encoder_outputs)
+        return self.W1(encoder_outputs)
 
-        # (batch_size, 1 (unsqueezed), hidden_size)
-        decoder_transform = self.W2(decoder_state).unsqueeze(1)
+    def logits(self, encoder_transform, decoder_state):
+        # decoder_state is either a single step (batch_size, hidden_size)
+        # or all decoding steps at once (batch_size, num_steps, hidden_size)
+        # (batch_size, [num_steps,] 1 (unsqueezed), hidden_size)
+        decoder_transform = self.W2(decoder_state).unsqueeze(-2)
+        if decoder_state.dim() == 3:
+            # (batch_size, 1 (unsqueezed), max_seq_len, hidden_size)
+            encoder_transform = encoder_transform.unsqueeze(1)
 
         # 1st line of Eq.(3) in the paper
-        # (batch_size, max_seq_len, 1) => (batch_size, max_seq_len)
-        u_i = self.vt(torch.tanh(encoder_transform + decoder_transform)).squeeze(-1)
+        # vt has a single output unit, so apply it as a dot product with its (hidden_size,) weight
+        # (batch_size, [num_steps,] max_seq_len, hidden_size) => (batch_size, [num_steps,] max_seq_len)
+        u_i = torch.tanh(encoder_transform + decoder_transform).matmul(
+            self.vt.weight.squeeze(0)
+        )
+
+        return u_i
+
+    def score(self, encoder_transform, decoder_state, mask):
+        u_i = self.logits(encoder_transform, decoder_state)
 
         # softmax with only valid inputs, excluding zero padded parts
         # log-softmax for a better numerical stability
@@ -129,6 +163,9 @@ class Attention(nn.Module):
 
         return log_score
 
+    def forward(self, decoder_state, encoder_outputs, mask):
+        return self.score(self.precompute(encoder_outputs), decoder_state, mask)
+
 
 class PointerNet(nn.Module):
     def __init__(
@@ -163,6 +200,14 @@ class PointerNet(nn.Module):
             batch_first=batch_first,
         )
         self.decoding_rnn = nn.LSTMCell(input_size=hidden_size, hidden_size=hidden_size)
+        # Runs all decoding steps at once when the decoder inputs are known (teacher forcing).
+        # It has no parameters of its own: decoding_rnn owns them and they are passed in
+        # with functional_call, so the state_dict (and copies of the model) only hold one set.
+        self.decoding_lstm = nn.LSTM(
+            input_size=hidden_size, hidden_size=hidden_size, batch_first=True
+        )
+        for name in ("weight_ih_l0", "weight_hh_l0", "bias_ih_l0", "bias_hh_l0"):
+            delattr(self.decoding_lstm, name)
         self.attn = Attention(hidden_size=hidden_size)
 
         for m in self.modules():
@@ -170,7 +215,14 @@ class PointerNet(nn.Module):
                 if m.bias is not None:
                     torch.nn.init.zeros_(m.bias)
 
-    def forward(self, input_seq, input_lengths):
+    def forward(self, input_seq, input_lengths, target_indices=None):
+        """
+        ``input_lengths`` should be a CPU tensor to avoid device to host copies (syncs).
+        If ``target_indices`` (batch_size, max_seq_len) is given, the decoder is teacher-forced:
+        the input of each step is the encoder output of the previous target pointer, so all steps
+        are computed at once. Padded targets (negative values) are ignored. Otherwise, the decoder
+        feeds back its own argmax pointer step by step.
+        """
 
         if self.batch_first:
             batch_size = input_seq.size(0)
@@ -179,21 +231,23 @@ class PointerNet(nn.Module):
             batch_size = input_seq.size(1)
             max_seq_len = input_seq.size(0)
 
-        # Embedding
-        embedded = self.embedding(input_seq)
-        # (batch_size, max_seq_len, embedding_dim)
-
         # encoder_output => (batch_size, max_seq_len, hidden_size) if batch_first else (max_seq_len, batch_size, hidden_size)
         # hidden_size is usually set same as embedding size
         # encoder_hidden => (num_layers * num_directions, batch_size, hidden_size) for each of h_n and c_n
-        encoder_outputs, encoder_hidden = self.encoder(embedded, input_lengths)
+        # The embedding is applied inside the encoder, to the non-padded inputs only
+        encoder_outputs, encoder_hidden = self.encoder(
+            input_seq, input_lengths, embedding=self.embedding
+        )
 
         if self.bidirectional:
             # Optionally, Sum bidirectional RNN outputs
-            encoder_outputs = (
-                encoder_outputs[:, :, : self.hidden_size]
-                + encoder_outputs[:, :, self.hidden_size :]
-            )
+            # (.., .., num_directions * hidden_size) => (.., .., hidden_size)
+            encoder_outputs = encoder_outputs.reshape(
+                encoder_outputs.size(0),
+                encoder_outputs.size(1),
+                self.num_directions,
+                self.hidden_size,
+            ).sum(dim=2)
 
         encoder_h_n, encoder_c_n = encoder_hidden
         encoder_h_n = encoder_h_n.view(
@@ -207,57 +261,117 @@ class PointerNet(nn.Module):
         decoder_input = encoder_outputs.new_zeros(
             torch.Size((batch_size, self.hidden_size))
         )
-        decoder_hidden = (
-            encoder_h_n[-1, 0, :, :].squeeze(),
-            encoder_c_n[-1, 0, :, :].squeeze(),
-        )
+        # (batch_size, hidden_size) each, no squeeze() as it would also drop batch_size == 1
+        decoder_hidden = (encoder_h_n[-1, 0], encoder_c_n[-1, 0])
 
-        range_tensor = torch.arange(
-            max_seq_len, device=input_lengths.device, dtype=input_lengths.dtype
-        ).expand(batch_size, max_seq_len, max_seq_len)
-        each_len_tensor = input_lengths.view(-1, 1, 1).expand(
-            batch_size, max_seq_len, max_seq_len
-        )
+        # (batch_size, max_seq_len), True for valid (non-padded) input positions
+        # The (CPU) lengths are copied to the device only once, here
+        mask_tensor = torch.arange(
+            max_seq_len, device=input_seq.device, dtype=input_lengths.dtype
+        ) < input_lengths.to(input_seq.device, non_blocking=True).unsqueeze(1)
 
-        row_mask_tensor = range_tensor < each_len_tensor
-        col_mask_tensor = row_mask_tensor.transpose(1, 2)
-        mask_tensor = row_mask_tensor * col_mask_tensor
+        # (batch_size, max_seq_len, hidden_size)
+        encoder_transform = self.attn.precompute(encoder_outputs)
+
+        if target_indices is not None:
+            # (batch_size, max_seq_len - 1), padding (-1) is clamped as its scores are not used
+            prev_targets = target_indices[:, :-1].clamp(min=0)
+            # (batch_size, max_seq_len, hidden_size)
+            decoder_inputs = torch.cat(
+                (
+                    decoder_input.unsqueeze(1),
+                    torch.gather(
+                        encoder_outputs,
+                        dim=1,
+                        index=prev_targets.unsqueeze(-1).expand(
+                            -1, -1, self.hidden_size
+                        ),
+                    ),
+                ),
+                dim=1,
+            )
+            # (batch_size, max_seq_len, hidden_size)
+            decoder_outputs, _ = torch.func.functional_call(
+                self.decoding_lstm,
+                {
+                    "weight_ih_l0": self.decoding_rnn.weight_ih,
+                    "weight_hh_l0": self.decoding_rnn.weight_hh,
+                    "bias_ih_l0": self.decoding_rnn.bias_ih,
+                    "bias_hh_l0": self.decoding_rnn.bias_hh,
+                },
+                (decoder_inputs, tuple(h.unsqueeze(0) for h in decoder_hidden)),
+            )
+            # (batch_size, max_seq_len, max_seq_len)
+            pointer_log_scores = self.attn.score(
+                encoder_transform, decoder_outputs, mask_tensor
+            )
+            pointer_argmaxs = pointer_log_scores.argmax(dim=-1)
 
-        pointer_log_scores = []
-        pointer_argmaxs = []
+            return pointer_log_scores, pointer_argmaxs, mask_tensor
 
-        for i in range(max_seq_len):
-            # We will simply mask out when calculating attention or max (and loss later)
-            # not all input and hiddens, just for simplicity
-            sub_mask = mask_tensor[:, i, :].float()
+        # Used to pick one encoder output per sequence at every decoding step
+        batch_index = torch.arange(batch_size, device=encoder_outputs.device)
 
-            # h, c: (batch_size, hidden_size)
-            h_i, c_i = self.decoding_rnn(decoder_input, decoder_hidden)
+        # Each decoding step writes its outputs into these in place
+        # (batch_size, max_seq_len, max_seq_len)
+        pointer_log_scores = encoder_outputs.new_empty(
+            batch_size,
+            max_seq_len,
+            max_seq_len,
+            dtype=torch.promote_types(encoder_outputs.dtype, torch.float),
+        )
+        # (batch_size, max_seq_len)
+        pointer_argmaxs = torch.empty(
+            batch_size, max_seq_len, dtype=torch.long, device=encoder_outputs.device
+        )
 
-            # next hidden
-            decoder_hidden = (h_i, c_i)
+        # Every step after the longest sequence is fully padded, so stop decoding there and fill
+        # the rest with zeros; callers must keep masking the loss by length as before.
+        # The loop length is data dependent, so keep the full length when compiling (static shapes)
+        if torch.compiler.is_compiling():
+            num_steps = max_seq_len
+        else:
+            num_steps = int(input_lengths.max().item())
+        pointer_log_scores[:, num_steps:, :] = 0
+        pointer_argmaxs[:, num_steps:] = 0
+
+        for i in range(num_steps):
+            # next hidden, h and c: (batch_size, hidden_size)
+            decoder_hidden = self.decoding_rnn(decoder_input, decoder_hidden)
+            h_i = decoder_hidden[0]
 
             # Get a pointer distribution over the encoder outputs using attention
+            # We will simply mask out padded inputs when calculating attention (and loss later),
+            # decoding steps beyond each sequence length are left to the loss to ignore
             # (batch_size, max_seq_len)
-            log_pointer_score = self.attn(h_i, encoder_outputs, sub_mask)
-            pointer_log_scores.append(log_pointer_score)
-
-            # Get the indices of maximum pointer
-            _, masked_argmax = masked_max(
-                log_pointer_score, sub_mask, dim=1, keepdim=True
-            )
+            u_i = self.attn.logits(encoder_transform, h_i)
 
-            pointer_argmaxs.append(masked_argmax)
-            index_tensor = masked_argmax.unsqueeze(-1).expand(
-                batch_size, 1, self.hidden_size
+            # Masked log-softmax and the indices of maximum pointer
+            # (batch_size, max_seq_len), (batch_size)
+            log_pointer_score, masked_argmax = masked_log_softmax_argmax(
+                u_i, mask_tensor
             )
+            pointer_log_scores[:, i, :] = log_pointer_score
+            pointer_argmaxs[:, i] = masked_argmax
 
             # (batch_size, hidden_size)
-            decoder_input = torch.gather(
-                encoder_outputs, dim=1, index=index_tensor
-            ).squeeze(1)
-
-        pointer_log_scores = torch.stack(pointer_log_scores, 1)
-        pointer_argmaxs = torch.cat(pointer_argmaxs, 1)
+            decoder_input = encoder_outputs[batch_index, masked_argmax]
 
         return pointer_log_scores, pointer_argmaxs, mask_tensor
+
+
+def quantize_for_inference(model: PointerNet) -> PointerNet:
+    """
+    Returns a copy of ``model`` for (CPU) inference with int8 dynamically quantized weights for the
+    embedding, the encoder LSTM, the decoder LSTM cell and the W1, W2 attention layers. ``vt`` is
+    kept in float as its weight is used directly. The quantized copy only supports the
+    free-running decoder (no ``target_indices``), so the float model should be kept for training.
+    A model wrapped by ``torch.compile`` is unwrapped first, and the returned copy is not compiled.
+    """
+    # The modules are selected by name, which would be prefixed by "_orig_mod." if compiled
+    model = getattr(model, "_orig_mod", model)
+    return torch.ao.quantization.quantize_dynamic(
+        model,
+        {"embedding", "encoder.rnn", "decoding_rnn", "attn.W1", "attn.W2"},
+        dtype=torch.qint8,
+    )
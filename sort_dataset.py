@@ -2,6 +2,7 @@ import itertools
 
 import numpy as np
 import torch
+import torch.nn.functional as F
 from torch.utils.data import Dataset
 import torch.sparse as S
 
@@ -34,7 +35,16 @@ class IntegerSortDataset(Dataset):
 		return len(self.seqs)
 
 
-def sparse_seq_collate_fn(batch):
+def bucket_length(length):
+	"""Rounds a sequence length up to the next power of two"""
+	return 1 << (length - 1).bit_length()
+
+
+def sparse_seq_collate_fn(batch, bucket=False):
+	"""
+	If bucket is True, sequences and labels are padded up to a power of two length (see bucket_length)
+	so that only a few distinct shapes are seen, e.g., by a model compiled with torch.compile(dynamic=False)
+	"""
 	batch_size = len(batch)
 
 	sorted_seqs, sorted_lengths, sorted_labels = zip(*sorted(batch, key=lambda x: x[1], reverse=True))
@@ -56,4 +66,9 @@ def sparse_seq_collate_fn(batch):
 	# TODO: Meanwhile, use a dense tensor when num_workers >= 1.
 	seq_tensor = seq_tensor.to_dense()
 
+	if bucket:
+		num_pads = bucket_length(sorted_lengths[0]) - sorted_lengths[0]
+		seq_tensor = F.pad(seq_tensor, (0, 0, 0, num_pads))
+		label_tensor = F.pad(label_tensor, (0, num_pads), value=-1)
+
 	return seq_tensor, length_tensor, label_tensor
@@ -1,5 +1,7 @@
 import argparse
+import functools
 import random
+import sys
 import warnings
 
 from tqdm import tqdm
@@ -13,7 +15,7 @@ from torch.utils.data import DataLoader
 
 
 from sort_dataset import IntegerSortDataset, sparse_seq_collate_fn
-from model import PointerNet
+from model import PointerNet, quantize_for_inference
 
 parser = argparse.ArgumentParser(description='PtrNet-Sorting-Integer')
 
@@ -32,6 +34,9 @@ parser.add_argument('--lr', type=float, default=1e-1, help='learning rate (defau
 parser.add_argument('--wd', default=1e-5, type=float, help='weight decay (default: 1e-5)')
 
 parser.add_argument('--workers', type=int, default=4, help='number of data loading workers (default: 4)')
+parser.add_argument('--compile', action='store_true', default=False, help='compiles the model with torch.compile and pads batches to power of two lengths')
+parser.add_argument('--quantize', action='store_true', default=False, help='tests an int8 dynamically quantized copy of the model on CPU')
+parser.add_argument('--amp', action='store_true', default=False, help='runs the forward passes under bfloat16 autocast')
 parser.add_argument('--no-cuda', action='store_true', default=False, help='disables CUDA training')
 parser.add_argument('--seed', type=int, default=1, help='random seed (default: 1)')
 
@@ -65,8 +70,9 @@ def masked_accuracy(output, target, mask):
 		return accuracy
 
 
-def main():
-	args = parser.parse_args([])
+def main(argv=()):
+	# Defaults to no arguments so that main() can still be called from e.g. a notebook
+	args = parser.parse_args(list(argv))
 
 	if args.seed is not None:
 		random.seed(args.seed)
@@ -82,15 +88,22 @@ def main():
 	device = torch.device("cuda" if use_cuda else "cpu")
 	cudnn.benchmark = True if use_cuda else False
 
+	# With --compile, a graph is compiled for each distinct (batch, length) shape, so the lengths are bucketed
+	collate_fn = functools.partial(sparse_seq_collate_fn, bucket=args.compile)
+
 	train_set = IntegerSortDataset(num_samples=args.train_samples, high=args.high, min_len=args.min_length, max_len=args.max_length, seed=1)
-	train_loader = DataLoader(dataset=train_set, batch_size=args.batch_size, shuffle=True, num_workers=args.workers, collate_fn=sparse_seq_collate_fn)
+	train_loader = DataLoader(dataset=train_set, batch_size=args.batch_size, shuffle=True, num_workers=args.workers, collate_fn=collate_fn)
 
 	test_set = IntegerSortDataset(num_samples=args.test_samples, high=args.high, min_len=args.min_length, max_len=args.max_length, seed=2)
-	test_loader = DataLoader(dataset=test_set, batch_size=args.batch_size, shuffle=False, num_workers=args.workers, collate_fn=sparse_seq_collate_fn)
+	test_loader = DataLoader(dataset=test_set, batch_size=args.batch_size, shuffle=False, num_workers=args.workers, collate_fn=collate_fn)
 
 	model = PointerNet(input_dim=args.high, embedding_dim=args.emb_dim, hidden_size=args.emb_dim).to(device)
 	optimizer = Adam(model.parameters(), lr=args.lr, weight_decay=args.wd)
 
+	if args.compile:
+		# Note that the first batch of each new input shape (and of train/eval mode) is slow as it triggers compilation
+		model = torch.compile(model, mode='reduce-overhead', dynamic=False)
+
 	train_loss = AverageMeter()
 	train_accuracy = AverageMeter()
 	test_loss = AverageMeter()
@@ -101,10 +114,12 @@ def main():
 		model.train()
 		tq = tqdm(train_loader,total=len(train_loader), desc='Train Epoch {}'.format(epoch), unit='batch')
 		for batch_idx, (seq, length, target) in enumerate(tq):
-			seq, length, target = seq.to(device), length.to(device), target.to(device)
+			# Lengths are kept on CPU
+			seq, target = seq.to(device), target.to(device)
 
 			optimizer.zero_grad()
-			log_pointer_score, argmax_pointer, mask = model(seq, length)
+			with torch.autocast(device_type=device.type, dtype=torch.bfloat16, enabled=args.amp):
+				log_pointer_score, argmax_pointer, mask = model(seq, length, target)
 
 			unrolled = log_pointer_score.view(-1, log_pointer_score.size(-1))
 			loss = F.nll_loss(unrolled, target.view(-1), ignore_index=-1)
@@ -115,7 +130,6 @@ def main():
 
 			train_loss.update(loss.item(), seq.size(0))
 
-			mask = mask[:, 0, :]
 			train_accuracy.update(masked_accuracy(argmax_pointer, target, mask).item(), mask.int().sum().item())
 
 			if batch_idx % 20 == 0 or True:
@@ -126,22 +140,28 @@ def main():
 
 	# Test
 	model.eval()
-	for seq, length, target in test_loader:
-		seq, length, target = seq.to(device), length.to(device), target.to(device)
+	test_model = model
+	if args.quantize:
+		# Dynamic quantization only runs on CPU
+		device = torch.device("cpu")
+		test_model = quantize_for_inference(model.to(device))
+
+	with torch.inference_mode(), torch.autocast(device_type=device.type, dtype=torch.bfloat16, enabled=args.amp):
+		for seq, length, target in test_loader:
+			seq, target = seq.to(device), target.to(device)
 
-		log_pointer_score, argmax_pointer, mask = model(seq, length)
-		unrolled = log_pointer_score.view(-1, log_pointer_score.size(-1))
-		loss = F.nll_loss(unrolled, target.view(-1), ignore_index=-1)
-		assert not np.isnan(loss.item()), 'Model diverged with loss = NaN'
+			log_pointer_score, argmax_pointer, mask = test_model(seq, length)
+			unrolled = log_pointer_score.view(-1, log_pointer_score.size(-1))
+			loss = F.nll_loss(unrolled, target.view(-1), ignore_index=-1)
+			assert not np.isnan(loss.item()), 'Model diverged with loss = NaN'
 
-		test_loss.update(loss.item(), seq.size(0))
+			test_loss.update(loss.item(), seq.size(0))
 
-		mask = mask[:, 0, :]
-		test_accuracy.update(masked_accuracy(argmax_pointer, target, mask).item(), mask.int().sum().item())
+			test_accuracy.update(masked_accuracy(argmax_pointer, target, mask).item(), mask.int().sum().item())
 		
 	print('Epoch {}: Test\tLoss: {:.6f}\tAccuracy: {:.6f}'.format(epoch, test_loss.avg, test_accuracy.avg))
 	return model,test_set,test_loader
 	
 
 if __name__ == '__main__':
-	main()
+	main(sys.argv[1:])